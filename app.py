@@ -1,37 +1,202 @@
+import atexit
+import hashlib
 import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import requests
-from flask import Flask, render_template, request
+import diskcache
+from cachetools import TLRUCache, TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, jsonify, render_template, request
+from flask_compress import Compress
 from dotenv import load_dotenv
 from datetime import datetime, timezone
 
 # matplotlib for server-side charts
 import matplotlib
 matplotlib.use("Agg")  # non-GUI backend for servers / PyCharm
-import matplotlib.pyplot as plt
+import matplotlib.style
+import numpy as np
+from matplotlib.figure import Figure
+
+# ---- nicer dark chart style ----
+matplotlib.style.use("default")
+# charts are served as SVG; keep labels as real <text> instead of glyph
+# outlines, which makes the files smaller and quicker to write
+matplotlib.rcParams["svg.fonttype"] = "none"
 
 load_dotenv()
 
+# Worker threads shared by all requests (chart rendering, outbound calls)
+# so we don't spin up a fresh pool per page render
+EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="wx")
+atexit.register(EXECUTOR.shutdown)
+
+# Pool of reusable chart figures. Figures are built with the OO API (not
+# pyplot), so they never touch pyplot's global figure registry; artists are
+# still not thread-safe, so each render checks out its own figure. The pool
+# grows to at most the number of concurrent renders.
+_CHART_FIGURES = queue.LifoQueue()
+
+# Condition keywords -> background theme, in priority order (e.g. "rain with
+# thunder" is a storm). Matched with one regex pass over the condition text.
+_BG_THEMES = [
+    ("storm", ["thunder", "storm"]),
+    ("snow", ["snow", "blizzard", "sleet", "ice"]),
+    ("rain", ["rain", "drizzle", "shower"]),
+    ("fog", ["fog", "mist", "haze", "overcast"]),
+    ("cloudy", ["cloud"]),
+]
+_BG_MAP = {word: (rank, theme) for rank, (theme, words) in enumerate(_BG_THEMES) for word in words}
+_BG_RE = re.compile("|".join(_BG_MAP))
+
+_MONTHS = [
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+]
+
+# [epoch hour, "YYYYMMDDHH"] of the last weather-map timestamp we formatted
+_MAP_TS_CACHE = [0, ""]
+
+
+class _SafeNameTable(dict):
+    """
+    str.translate() table that keeps letters, digits, '-' and '_' and
+    drops everything else. Filled in lazily as new characters show up.
+    """
+
+    def __missing__(self, codepoint: int) -> int | None:
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in "-_" else None
+        self[codepoint] = value
+        return value
+
+
+_SAFE_NAME_TABLE = _SafeNameTable()
+
+# Background chart renders in flight in this process, keyed by filename
+_CHART_JOBS = {}
+_CHART_JOBS_LOCK = threading.Lock()
+
+# A day's chart is reused from disk while younger than this (seconds)
+CHART_MAX_AGE = 30 * 60
+
 app = Flask(__name__)
 
+# brotli/gzip-compress responses (the forecast page is large, repetitive HTML)
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 500
+Compress(app)
+
 API_KEY = os.getenv("WEATHER_API_KEY")
 
 # How many days we always ask WeatherAPI for
 FULL_FORECAST_DAYS = 14
 
+# Forecast data only refreshes every ~10 minutes upstream, so keep
+# successful responses in memory for that long (tunable via .env).
+# Entries are (json_bytes, fetched_at) and expire WEATHER_CACHE_TTL after
+# they were fetched, even when promoted later from the disk tier.
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "600"))
+_WEATHER_CACHE = TLRUCache(
+    maxsize=512,
+    ttu=lambda _key, value, _now: value[1] + WEATHER_CACHE_TTL,
+    timer=time.time,
+)
+_WEATHER_CACHE_LOCK = threading.Lock()
+_QUERY_JUNK_RE = re.compile(r"[^\w.\-]+")
+
+# Rendered result pages for repeat searches, kept briefly
+_HTML_CACHE = TTLCache(maxsize=256, ttl=60)
+_HTML_CACHE_LOCK = threading.Lock()
+
+# Second cache tier on disk: survives restarts/reloads and is shared
+# between worker processes. Entries are (data, etag, last_modified, fetched_at);
+# only the parsed JSON payload is stored, never the Response object.
+WEATHER_DISK_CACHE = diskcache.Cache(
+    os.path.join(app.root_path, ".weather_cache"),
+    size_limit=50 * 1024 * 1024,
+)
+
+# Stale disk entries are kept this long (seconds) so their ETag/Last-Modified
+# can be used to revalidate with a conditional GET instead of a full download
+WEATHER_REVALIDATE_WINDOW = 24 * 60 * 60
+
+# Shared HTTP session so the TCP/TLS connection to WeatherAPI is kept alive
+# between requests, with retries on transient upstream failures
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,  # hand the final response to our own error handling
+        ),
+    ),
+)
+
+# Ask for compressed JSON explicitly ("br" decoding in urllib3 relies on the
+# brotli package, which Flask-Compress already pulls in)
+SESSION.headers.update({"Accept": "application/json", "Accept-Encoding": "br, gzip, deflate"})
+
+
+def _normalize_query(query: str) -> str:
+    """
+    Cache key form of a location query: lowercase, with punctuation and
+    runs of whitespace collapsed, so "New York, NY" and "new york ny" share
+    an entry. '.' and '-' are kept so lat/lon queries like "40.7,-74.0"
+    stay distinct.
+    """
+    return _QUERY_JUNK_RE.sub(" ", query.lower()).strip()
+
 
 def fetch_weather(query: str, days: int = FULL_FORECAST_DAYS):
     """
     Calls WeatherAPI.com forecast endpoint for the given location query
     and number of days.
     Returns (data, error_message).
+    Successful responses are cached for WEATHER_CACHE_TTL seconds, then
+    revalidated with a conditional GET when WeatherAPI sent an ETag.
     """
     if not API_KEY:
         return None, "Weather API key is not configured. Set WEATHER_API_KEY in your .env file."
 
+    cache_key = (_normalize_query(query), int(days))
+    # the memory tier holds raw JSON so every request parses its own copy;
+    # callers add per-request fields (charts, pretty dates) to the result
+    with _WEATHER_CACHE_LOCK:
+        cached = _WEATHER_CACHE.get(cache_key)
+    if cached is not None:
+        return orjson.loads(cached[0]), None
+
+    disk_key = f"forecast|{cache_key[0]}|{cache_key[1]}"
+    entry = WEATHER_DISK_CACHE.get(disk_key)
+    if entry is not None and time.time() - entry[3] < WEATHER_CACHE_TTL:
+        with _WEATHER_CACHE_LOCK:
+            _WEATHER_CACHE[cache_key] = (orjson.dumps(entry[0]), entry[3])
+        return entry[0], None
+
+    # expired entry: ask WeatherAPI whether it changed (304 = reuse our copy)
+    headers = {}
+    if entry is not None:
+        if entry[1]:
+            headers["If-None-Match"] = entry[1]
+        if entry[2]:
+            headers["If-Modified-Since"] = entry[2]
+
     base_url = "https://api.weatherapi.com/v1/forecast.json"
 
     try:
-        resp = requests.get(
+        resp = SESSION.get(
             base_url,
             params={
                 "key": API_KEY,
@@ -40,82 +205,168 @@ def fetch_weather(query: str, days: int = FULL_FORECAST_DAYS):
                 "aqi": "no",
                 "alerts": "no",
             },
+            headers=headers,
             timeout=10,
         )
     except requests.RequestException as e:
         return None, f"Network error while contacting weather service: {e}"
 
-    if resp.status_code != 200:
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+
+    if resp.status_code == 304 and entry is not None:
+        # unchanged upstream: keep our copy and restart its TTL
+        data = entry[0]
+        etag = etag or entry[1]
+        last_modified = last_modified or entry[2]
+    elif resp.status_code != 200:
         try:
-            err_msg = resp.json().get("error", {}).get("message", "Unknown error from weather service.")
+            err_msg = orjson.loads(resp.content).get("error", {}).get("message", "Unknown error from weather service.")
         except Exception:
             err_msg = f"Unexpected error from weather service (status {resp.status_code})."
         return None, err_msg
-
-    try:
-        data = resp.json()
-    except ValueError:
-        return None, "Failed to parse response from weather service."
+    else:
+        try:
+            data = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            return None, "Failed to parse response from weather service."
+
+    fetched_at = time.time()
+    with _WEATHER_CACHE_LOCK:
+        _WEATHER_CACHE[cache_key] = (orjson.dumps(data), fetched_at)
+    WEATHER_DISK_CACHE.set(
+        disk_key,
+        (data, etag, last_modified, fetched_at),
+        expire=WEATHER_CACHE_TTL + WEATHER_REVALIDATE_WINDOW,
+    )
 
     return data, None
 
 
-def generate_hourly_chart(day_data: dict, location_name: str) -> str | None:
+def _build_chart_figure():
     """
-    Given one day's forecast data from WeatherAPI, generate an hourly
-    temperature chart as a PNG in static/charts and return the filename.
+    Build the static parts of the hourly chart (figure, axes styling,
+    line and fill artists) once so they can be reused for every day.
     """
-    hours_data = day_data.get("hour", [])
-    if not hours_data:
-        return None
+    fig = Figure(figsize=(7.5, 3), facecolor="#020617")
+    ax = fig.subplots()
 
-    times_full = [h.get("time", "") for h in hours_data]
-    temps = [h.get("temp_f") for h in hours_data]
+    ax.set_facecolor("#020617")
 
-    if not temps or not times_full:
-        return None
+    (line,) = ax.plot([], [], color="#38bdf8", marker="o", linewidth=2)
+    fill = ax.fill_between([], [], color="#38bdf8", alpha=0.18)
+
+    ax.tick_params(axis="y", colors="#e5e7eb", labelsize=8)
+    ax.set_ylabel("Temperature (°F)", color="#e5e7eb", fontsize=9)
+
+    for spine in ax.spines.values():
+        spine.set_color("#1f2937")
+
+    ax.grid(color="#1f2937", alpha=0.7, linestyle="--", linewidth=0.5)
 
-    hours = [(t.split(" ")[1] if " " in t else t) for t in times_full]
+    return fig, ax, line, fill
 
-    charts_dir = os.path.join(app.static_folder, "charts")
-    os.makedirs(charts_dir, exist_ok=True)
 
+def _acquire_chart_figure():
+    """
+    Take a prepared chart figure from the pool, building a new one if
+    every existing figure is in use by another thread.
+    Return it with _CHART_FIGURES.put() when done.
+    """
+    try:
+        return _CHART_FIGURES.get_nowait()
+    except queue.Empty:
+        return _build_chart_figure()
+
+
+def _chart_location_key(location: dict) -> str:
+    """
+    File-name stem for a place's charts, like "Paris-3f9c2a1b7e".
+    location.name alone isn't unique (Paris, France vs Paris, Texas), so a
+    short hash of the name, region, country and coordinates is appended.
+    """
+    safe_loc = str(location.get("name", "")).translate(_SAFE_NAME_TABLE) or "location"
+    identity = "|".join(str(location.get(field, "")) for field in ("name", "region", "country", "lat", "lon"))
+    return f"{safe_loc}-{hashlib.sha1(identity.encode('utf-8')).hexdigest()[:10]}"
+
+
+def _chart_paths(day_data: dict, location_key: str) -> tuple[str, str]:
+    """
+    Returns (filename, filepath) of the hourly chart for one forecast day.
+    location_key comes from _chart_location_key().
+    """
     date_str = day_data.get("date", "unknown")
-    safe_loc = "".join(c for c in location_name if c.isalnum() or c in ("-", "_")).strip() or "location"
-    filename = f"{safe_loc}_{date_str}.png"
-    filepath = os.path.join(charts_dir, filename)
+    filename = f"{location_key}_{date_str}.svg"
+    return filename, os.path.join(app.static_folder, "charts", filename)
 
-    # ---- nicer dark chart style ----
-    plt.style.use("default")
 
-    fig, ax = plt.subplots(figsize=(7.5, 3), facecolor="#020617")
-    ax.set_facecolor("#020617")
+def _fresh_chart_url(filename: str, filepath: str) -> str | None:
+    """
+    Returns "filename?v=<mtime in ns>" if the chart on disk is younger than
+    CHART_MAX_AGE, otherwise None.
+    """
+    try:
+        mtime_ns = os.stat(filepath).st_mtime_ns
+    except OSError:
+        return None
+    if time.time() - mtime_ns / 1e9 < CHART_MAX_AGE:
+        return f"{filename}?v={mtime_ns}"
+    return None
 
-    x_vals = list(range(len(temps)))
-    ax.plot(x_vals, temps, color="#38bdf8", marker="o", linewidth=2)
-    ax.fill_between(x_vals, temps, color="#38bdf8", alpha=0.18)
 
-    step = max(1, len(hours) // 8)
-    tick_positions = list(range(0, len(hours), step))
-    tick_labels = [hours[i] for i in tick_positions]
+def generate_hourly_chart(day_data: dict, location_key: str) -> str | None:
+    """
+    Given one day's forecast data from WeatherAPI and the place's
+    _chart_location_key(), generate an hourly temperature chart as an SVG
+    in static/charts and return the filename, with a "?v=<mtime>" suffix
+    so browsers can cache each version forever.
+    """
+    hours_data = day_data.get("hour", [])
+    if not hours_data:
+        return None
 
-    ax.set_xticks(tick_positions)
-    ax.set_xticklabels(tick_labels, rotation=45, fontsize=8, color="#e5e7eb")
-    ax.tick_params(axis="y", colors="#e5e7eb", labelsize=8)
+    filename, filepath = _chart_paths(day_data, location_key)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-    ax.set_ylabel("Temperature (°F)", color="#e5e7eb", fontsize=9)
-    ax.set_title(f"Hourly Temperature — {date_str}", color="#e5e7eb", fontsize=10)
+    # same location + date rendered recently: keep the existing chart
+    chart_url = _fresh_chart_url(filename, filepath)
+    if chart_url:
+        return chart_url
 
-    for spine in ax.spines.values():
-        spine.set_color("#1f2937")
+    count = len(hours_data)
+    temps = np.fromiter((h.get("temp_f") for h in hours_data), dtype=float, count=count)
+    times_full = (h.get("time", "") for h in hours_data)
+    hours = np.array([(t.split(" ")[1] if " " in t else t) for t in times_full])
+    x_vals = np.arange(count)
+    date_str = day_data.get("date", "unknown")
 
-    ax.grid(color="#1f2937", alpha=0.7, linestyle="--", linewidth=0.5)
+    fig, ax, line, fill = _acquire_chart_figure()
+    try:
+        line.set_data(x_vals, temps)
+        fill.set_data(x_vals, temps, 0)
+
+        step = max(1, count // 8)
+        tick_positions = x_vals[::step]
+        tick_labels = hours[tick_positions]
+
+        ax.set_xticks(tick_positions)
+        ax.set_xticklabels(tick_labels, rotation=45, fontsize=8, color="#e5e7eb")
+        ax.set_title(f"Hourly Temperature — {date_str}", color="#e5e7eb", fontsize=10)
+
+        # relim() ignores collections, so add the fill's extent (down to 0°F) back in
+        ax.relim()
+        ax.update_datalim(fill.get_datalim(ax.transData).get_points())
+        ax.autoscale_view()
 
-    fig.tight_layout()
-    fig.savefig(filepath, transparent=True)
-    plt.close(fig)
+        fig.tight_layout()
+        # write to a temp file first so /chart_status never sees a half-written chart
+        tmp_path = f"{filepath}.{os.getpid()}-{threading.get_ident()}.tmp"
+        fig.savefig(tmp_path, format="svg", transparent=True)
+        os.replace(tmp_path, filepath)
+    finally:
+        _CHART_FIGURES.put((fig, ax, line, fill))
 
-    return filename
+    return _fresh_chart_url(filename, filepath)
 
 
 def derive_bg_class(current: dict) -> str:
@@ -129,44 +380,73 @@ def derive_bg_class(current: dict) -> str:
     text = str(current.get("condition", {}).get("text", "")).lower()
     is_day = current.get("is_day", 1)
 
-    if any(word in text for word in ["thunder", "storm"]):
-        return "storm"
-    if any(word in text for word in ["snow", "blizzard", "sleet", "ice"]):
-        return "snow"
-    if any(word in text for word in ["rain", "drizzle", "shower"]):
-        return "rain"
-    if any(word in text for word in ["fog", "mist", "haze", "overcast"]):
-        return "fog"
-    if "cloud" in text or "overcast" in text:
-        return "cloudy"
+    matches = _BG_RE.findall(text)
+    if matches:
+        return min(_BG_MAP[word] for word in matches)[1]
     # fallback sunny/clear
     return "clear-day" if is_day == 1 else "clear-night"
 
 
+def _forget_chart_job(filename: str, future) -> None:
+    _CHART_JOBS.pop(filename, None)
+    if future.exception() is not None:
+        app.logger.error("Rendering chart %s failed: %s", filename, future.exception())
+
+
+def _schedule_chart(day_data: dict, location_key: str, filename: str) -> None:
+    """
+    Queue generate_hourly_chart on the shared executor, unless this
+    process is already rendering the same chart.
+    """
+    with _CHART_JOBS_LOCK:
+        if filename in _CHART_JOBS:
+            return
+        future = EXECUTOR.submit(generate_hourly_chart, day_data, location_key)
+        _CHART_JOBS[filename] = future
+        future.add_done_callback(lambda f: _forget_chart_job(filename, f))
+
+
 def attach_charts_to_forecast(weather_data: dict) -> None:
     """
-    For each forecast day, generate an hourly chart and attach a
-    'chart_image' field to the day's data, plus a human-readable date.
+    For each forecast day, attach a human-readable date and either a
+    'chart_image' (chart already on disk) or a 'chart_pending' filename
+    (chart queued for rendering in the background).
+    weather_data must be this request's own copy (fetch_weather returns
+    one per call), since the fields are added in place.
     """
     try:
-        location_name = weather_data["location"]["name"]
+        location_key = _chart_location_key(weather_data["location"])
         forecast_days = weather_data["forecast"]["forecastday"]
-    except (KeyError, TypeError):
+    except (AttributeError, KeyError, TypeError):
         return
 
     for day in forecast_days:
         # pretty date like "December 12, 2025"
         raw_date = day.get("date")
         if raw_date:
+            # WeatherAPI dates are always YYYY-MM-DD, so slice instead of strptime
             try:
-                dt = datetime.strptime(raw_date, "%Y-%m-%d")
-                day["date_pretty"] = f"{dt.strftime('%B')} {dt.day}, {dt.year}"
+                if len(raw_date) != 10 or raw_date[4] != "-" or raw_date[7] != "-":
+                    raise ValueError(raw_date)
+                year, month, dom = int(raw_date[0:4]), int(raw_date[5:7]), int(raw_date[8:10])
+                if not 1 <= month <= 12:
+                    raise ValueError(raw_date)
+                day["date_pretty"] = f"{_MONTHS[month - 1]} {dom}, {year}"
             except ValueError:
                 day["date_pretty"] = raw_date
 
-        chart_filename = generate_hourly_chart(day, location_name)
-        if chart_filename:
-            day["chart_image"] = chart_filename
+        if not day.get("hour"):
+            continue
+
+        # serve a recent chart straight away; otherwise render it in the
+        # background and let the page poll /chart_status for it
+        filename, filepath = _chart_paths(day, location_key)
+        chart_url = _fresh_chart_url(filename, filepath)
+        if chart_url:
+            day["chart_image"] = chart_url
+        else:
+            _schedule_chart(day, location_key, filename)
+            day["chart_pending"] = filename
 
 
 def compute_weather_map_timestamp() -> str:
@@ -174,8 +454,38 @@ def compute_weather_map_timestamp() -> str:
     Returns WeatherAPI weather-map timestamp in the form YYYYMMDDHH (UTC),
     used in the tile URL like .../{YYYYMMDDHH}/{z}/{x}/{y}.png
     """
-    now_utc = datetime.now(timezone.utc)
-    return now_utc.strftime("%Y%m%d%H")
+    hour = int(time.time()) // 3600
+    if _MAP_TS_CACHE[0] != hour:
+        _MAP_TS_CACHE[:] = [hour, datetime.fromtimestamp(hour * 3600, timezone.utc).strftime("%Y%m%d%H")]
+    return _MAP_TS_CACHE[1]
+
+
+@app.after_request
+def cache_chart_images(response):
+    """
+    A chart URL never changes content, so browsers needn't refetch it:
+    the file name is unique per place and day (_chart_location_key), and
+    the "?v=<mtime>" suffix changes whenever that file is re-rendered.
+    """
+    if response.status_code == 200 and request.path.startswith(f"{app.static_url_path}/charts/"):
+        response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    return response
+
+
+@app.route("/chart_status")
+def chart_status():
+    """
+    Polled by the day modal while a chart is rendering in the background.
+    name is the day's 'chart_pending' filename, which includes the place's
+    _chart_location_key(), so another city with the same name never counts.
+    Returns {"ready": bool, "chart_image": "name.svg?v=..." or null}.
+    """
+    name = request.args.get("name", "")
+    if not name.endswith(".svg") or os.path.basename(name) != name:
+        return jsonify({"ready": False, "chart_image": None}), 404
+
+    chart_url = _fresh_chart_url(name, os.path.join(app.static_folder, "charts", name))
+    return jsonify({"ready": chart_url is not None, "chart_image": chart_url})
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -190,20 +500,33 @@ def index():
     # compute a timestamp for WeatherAPI map tiles (UTC YYYYMMDDHH)
     map_timestamp = compute_weather_map_timestamp()
 
+    html_key = None
+    cacheable = False
+
     if request.method == "POST":
         query = request.form.get("location", "").strip()
 
         if not query:
             error = "Please enter a city name or ZIP code."
         else:
+            # same search again shortly after: reuse the page we rendered last time
+            html_key = (query, FULL_FORECAST_DAYS, days_view, map_timestamp)
+            with _HTML_CACHE_LOCK:
+                cached_html = _HTML_CACHE.get(html_key)
+            if cached_html is not None:
+                return cached_html
+
             weather_data, error = fetch_weather(query, days=FULL_FORECAST_DAYS)
             if weather_data and not error:
                 attach_charts_to_forecast(weather_data)
                 bg_theme = derive_bg_class(weather_data.get("current", {}))
                 # recompute timestamp right when we actually have data
                 map_timestamp = compute_weather_map_timestamp()
+                # pages still waiting on background charts aren't worth keeping
+                forecast_days = weather_data.get("forecast", {}).get("forecastday", [])
+                cacheable = not any("chart_pending" in day for day in forecast_days)
 
-    return render_template(
+    html = render_template(
         "index.html",
         query=query,
         weather=weather_data,
@@ -213,6 +536,12 @@ def index():
         map_timestamp=map_timestamp,
     )
 
+    if cacheable:
+        with _HTML_CACHE_LOCK:
+            _HTML_CACHE[html_key] = html
+
+    return html
+
 
 if __name__ == "__main__":
     app.run(debug=True)
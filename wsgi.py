@@ -0,0 +1,3 @@
+# WSGI entry point for production servers, e.g.
+#   gunicorn -k gthread --workers 2 --threads 16 --timeout 30 wsgi:app
+from app import app